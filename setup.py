@@ -17,6 +17,16 @@ install_requires = [
     'psycopg2-binary',
 ]
 
+extras_require = {
+    # For salesforce_requests_oauthlib.aio, Python 3.7 and up
+    'async': ['httpx'],
+    # Faster page parsing for RecordDecoder
+    'fastjson': ['orjson'],
+    # For query_columns()
+    'arrow': ['pyarrow'],
+    'numpy': ['numpy'],
+}
+
 
 setup(name='salesforce-requests-oauthlib',
     version=version,
@@ -35,6 +45,7 @@ setup(name='salesforce-requests-oauthlib',
     package_dir = {'': 'src'},include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points={
     }
 )
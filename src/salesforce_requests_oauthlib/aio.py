@@ -0,0 +1,565 @@
+'''
+    Copyright (c) 2016, Salesforce.org
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of Salesforce.org nor the names of
+      its contributors may be used to endorse or promote products derived
+      from this software without specific prior written permission.
+
+    THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+    "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+    LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+    FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+    INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+    BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+    LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+    CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+    LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+    ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+'''
+
+# asyncio sessions, for Python 3.7 and up.  Needs httpx, e.g.
+# pip install salesforce-requests-oauthlib[async]
+
+import asyncio
+import time
+from abc import ABCMeta
+from abc import abstractmethod
+import httpx
+from oauthlib.common import generate_token
+from oauthlib.oauth2 import WebApplicationClient
+from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
+from oauthlib.oauth2.rfc6749.clients import LegacyApplicationClient
+from oauthlib.oauth2.rfc6749.clients import ServiceApplicationClient
+from . import HiddenLocalStorage
+from . import TokenStorageMechanism
+from . import LogoutException
+from . import WebServerFlowNeeded
+from . import api_version_cache
+from . import jwt_token_cache
+from . import access_token_expiry_margin
+from . import authorization_url_template
+from . import default_session_timeout
+from . import revoke_url_template
+from . import token_url_template
+from . import _saved_access_token
+from . import _saved_access_token_is_fresh
+from . import _saved_refresh_token
+from . import _storable_token
+from . import _token_issued_at
+
+
+class AsyncTokenStorageMechanism(metaclass=ABCMeta):
+    # Per-user token storage that can be awaited.  Values are the same as
+    # TokenStorageMechanism's, a refresh token or a dict with the access
+    # token too.
+    @abstractmethod
+    async def get(self, username):
+        pass
+
+    @abstractmethod
+    async def put(self, username, token):
+        pass
+
+    @abstractmethod
+    async def delete(self, username):
+        pass
+
+
+class ExecutorStorage(AsyncTokenStorageMechanism):
+    # Runs any TokenStorageMechanism's blocking get(), put() and delete() in
+    # the event loop's executor, so file and database I/O doesn't stall
+    # other sessions
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+
+    async def get(self, username):
+        return await self._run(self.storage.get, username)
+
+    async def put(self, username, token):
+        await self._run(self.storage.put, username, token)
+
+    async def delete(self, username):
+        await self._run(self.storage.delete, username)
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            function,
+            *args
+        )
+
+
+class AsyncSalesforceOAuth2Session(object):
+    # SalesforceOAuth2Session for asyncio.  The refresh token, password, JWT
+    # bearer and web server flows work as they do there, except that the
+    # browser can't be launched from here: without a saved token, use
+    # authorization_url() and launch_flow(code_response).  Sessions can share
+    # one httpx.AsyncClient, and with it one set of connection pools.
+    def __init__(self, client_id, client_secret, username,
+                 sandbox=False,
+                 callback_url='https://localhost:60443',
+                 password=None,
+                 ignore_cached_refresh_tokens=False,
+                 version=None,
+                 custom_domain=None,
+                 oauth2client=None,
+                 token_storage=None,
+                 cache_access_tokens=False,
+                 session_timeout=default_session_timeout,
+                 retry_invalid_session=False,
+                 http_client=None,
+                 version_cache=None):
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.username = username
+        self.password = password
+        self.callback_url = callback_url
+
+        self.sandbox = sandbox
+        self.custom_domain = custom_domain
+        self.token_url = self._insert_domain(token_url_template)
+        self.authorization_url_location = self._insert_domain(
+            authorization_url_template
+        )
+
+        if oauth2client:
+            self.client = oauth2client
+        elif password is not None:
+            self.client = LegacyApplicationClient(client_id=client_id)
+        else:
+            self.client = WebApplicationClient(client_id=client_id)
+
+        if not isinstance(self.client, ServiceApplicationClient):
+            if token_storage is None:
+                token_storage = HiddenLocalStorage
+
+            if isinstance(token_storage, type):
+                token_storage = token_storage()
+            if isinstance(token_storage, TokenStorageMechanism):
+                token_storage = ExecutorStorage(token_storage)
+            self.token_storage = token_storage
+
+        self.ignore_cached_refresh_tokens = ignore_cached_refresh_tokens
+        self.cache_access_tokens = cache_access_tokens
+        self.session_timeout = session_timeout
+        self.retry_invalid_session = retry_invalid_session
+        self.access_token_unverified = False
+        self.bad_session = False
+
+        if version_cache is None:
+            version_cache = api_version_cache
+        self.version_cache = version_cache
+        self.version = version
+
+        # We only close a client we made ourselves
+        self.owns_http_client = http_client is None
+        if http_client is None:
+            http_client = httpx.AsyncClient()
+        self.http_client = http_client
+
+        self.token = {}
+        self.state = None
+
+        # The constructor can't await, so the token is retrieved or fetched
+        # by prepare(), or by the first request()
+        self.prepared = False
+        # Before Python 3.10 an asyncio.Lock binds to the loop current when
+        # it's created, so it waits for the first coroutine to make it
+        self._token_lock = None
+
+    async def __aenter__(self):
+        await self.prepare()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    @property
+    def access_token(self):
+        return self.token.get('access_token')
+
+    @property
+    def token_lock(self):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        return self._token_lock
+
+    async def prepare(self):
+        # Safe to await from several tasks, and more than once
+        async with self.token_lock:
+            if self.prepared:
+                return
+            await self._retrieve_or_fetch_token()
+            self.prepared = True
+
+    async def _retrieve_or_fetch_token(self):
+        if isinstance(self.client, ServiceApplicationClient):
+            await self.launch_jwt_bearer_flow()
+            return
+
+        saved_token = None
+
+        if not self.ignore_cached_refresh_tokens:
+            saved_token = await self.token_storage.get(self.username)
+
+        if saved_token is None:
+            if self.password is None:
+                # Nothing to do without the web server flow
+                return
+
+            await self.launch_password_flow()
+        elif self.cache_access_tokens and _saved_access_token_is_fresh(
+            saved_token,
+            self.session_timeout
+        ):
+            self.token = _saved_access_token(saved_token)
+            self.access_token_unverified = True
+        else:
+            self.token = _saved_refresh_token(saved_token)
+
+            try:
+                await self.refresh_token()
+            except WebServerFlowNeeded:
+                if self.password is None:
+                    self.bad_session = True
+                    self.token = {}
+                else:
+                    await self.launch_password_flow()
+            else:
+                if self.cache_access_tokens:
+                    await self.save_token()
+
+    async def renew_token(self, stale_access_token=None):
+        # As SalesforceOAuth2Session.renew_token(), tasks sharing this
+        # session renew only once per expired token
+        async with self.token_lock:
+            if stale_access_token is not None and \
+                    self.access_token != stale_access_token:
+                return
+
+            if isinstance(self.client, ServiceApplicationClient):
+                await self.launch_jwt_bearer_flow(
+                    stale_access_token=self.access_token
+                )
+            elif self.token.get('refresh_token') is not None:
+                await self.refresh_token()
+                await self.save_token()
+            elif self.password is not None:
+                await self.launch_password_flow()
+            else:
+                raise WebServerFlowNeeded(
+                    'no token available',
+                    self.authorization_url()
+                )
+
+    def token_expires_at(self):
+        return _token_issued_at(self.token) + self.session_timeout
+
+    async def save_token(self):
+        await self.token_storage.put(
+            self.username,
+            _storable_token(self.token, self.cache_access_tokens)
+        )
+
+    def _insert_domain(self, template):
+        if self.custom_domain is not None:
+            return template.format(
+                '{0}.my'.format(self.custom_domain)
+            )
+        else:
+            return template.format(
+                'test' if self.sandbox else 'login'
+            )
+
+    def authorization_url(self):
+        self.state = generate_token()
+        return self.client.prepare_request_uri(
+            self.authorization_url_location,
+            redirect_uri=self.callback_url,
+            state=self.state
+        )
+
+    async def launch_flow(self, code_response=None):
+        # As SalesforceOAuth2Session.launch_flow(), the password flow's token
+        # has no refresh token to save
+        if self.password is not None:
+            await self.launch_password_flow()
+            self.prepared = True
+            return
+
+        if code_response is None:
+            raise WebServerFlowNeeded(
+                'no token available',
+                self.authorization_url()
+            )
+
+        self.client.parse_request_uri_response(
+            code_response,
+            state=self.state
+        )
+        await self._fetch_token(self.client.prepare_request_body(
+            code=self.client.code,
+            redirect_uri=self.callback_url,
+            include_client_id=True,
+            client_secret=self.client_secret
+        ))
+
+        self.prepared = True
+        await self.save_token()
+
+    async def launch_password_flow(self):
+        await self._fetch_token(self.client.prepare_request_body(
+            username=self.username,
+            password=self.password,
+            include_client_id=True,
+            client_secret=self.client_secret
+        ))
+
+    async def launch_jwt_bearer_flow(self, stale_access_token=None):
+        cache_key = (
+            self.client_id,
+            self.client.subject,
+            self.client.audience
+        )
+
+        if self.cache_access_tokens:
+            token = jwt_token_cache.get(cache_key)
+            if token is not None and \
+                    token['access_token'] != stale_access_token:
+                self.token = token
+                self.access_token_unverified = True
+                return
+
+        # make JWT valid for only 3 minutes to prevent reuse later
+        await self._fetch_token(self.client.prepare_request_body(
+            expires_at=time.time() + 180
+        ))
+
+        if self.cache_access_tokens:
+            jwt_token_cache.put(
+                cache_key,
+                self.token,
+                self.token_expires_at() - access_token_expiry_margin
+            )
+
+    async def refresh_token(self):
+        try:
+            await self._fetch_token(self.client.prepare_refresh_body(
+                refresh_token=self.token['refresh_token'],
+                client_id=self.client_id,
+                client_secret=self.client_secret
+            ))
+        except InvalidGrantError:
+            raise WebServerFlowNeeded(
+                'Reauthentication needed',
+                self.authorization_url()
+            )
+
+    async def _fetch_token(self, body):
+        response = await self.http_client.post(
+            self.token_url,
+            content=body,
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+        )
+        token = self.client.parse_request_body_response(response.text)
+
+        # Salesforce doesn't send a new refresh token on refresh
+        if 'refresh_token' not in token and \
+                self.token.get('refresh_token') is not None:
+            token['refresh_token'] = self.token['refresh_token']
+        self.token = dict(token)
+
+    async def logout(self):
+        response = await self.http_client.post(
+            revoke_url_template.format(
+                'test' if self.sandbox else 'login'
+            ),
+            data={
+                'token': self.token['refresh_token']
+            }
+        )
+
+        await self.token_storage.delete(self.username)
+        self.token = {'access_token': None}
+
+        if response.status_code != 200:
+            raise LogoutException(
+                str(response.status_code) + ' ' + response.text
+            )
+
+    async def use_latest_version(self):
+        version = self.version_cache.get(self.token.get('instance_url'))
+        if version is None:
+            response = await self.get('/services/data/')
+            version = response.json()[-1]['version']
+            self.version_cache.put(self.token['instance_url'], version)
+        self.version = version
+
+    async def substitute_version(self, url):
+        if 'vXX.X' in url:
+            if self.version is None:
+                await self.use_latest_version()
+
+            url = url.replace('vXX.X', 'v{0}'.format(
+                self.version
+            ))
+        return url
+
+    async def query(self, query_string, api_version='XX.X',
+                    follow_next_records_url=True, batch_size=None):
+        pages = self.iter_query_pages(
+            query_string,
+            api_version,
+            batch_size=batch_size
+        )
+
+        if not follow_next_records_url:
+            try:
+                return await pages.__anext__()
+            finally:
+                await pages.aclose()
+
+        return [
+            record async for record in self.iter_query(
+                query_string,
+                api_version,
+                batch_size=batch_size
+            )
+        ]
+
+    async def iter_query(self, query_string, api_version='XX.X',
+                         batch_size=None):
+        async for query_response in self.iter_query_pages(
+            query_string,
+            api_version,
+            batch_size=batch_size
+        ):
+            for record in query_response['records']:
+                yield record
+
+    async def iter_query_pages(self, query_string, api_version='XX.X',
+                               batch_size=None):
+        headers = {}
+        if batch_size is not None:
+            headers['Sforce-Query-Options'] = 'batchSize={0}'.format(
+                batch_size
+            )
+
+        response = await self.get(
+            '/services/data/v{0}/query/'.format(
+                api_version
+            ),
+            params={
+                'q': query_string
+            },
+            headers=headers
+        )
+        response.raise_for_status()
+        query_response = response.json()
+
+        while True:
+            yield query_response
+
+            if query_response['done']:
+                return
+
+            response = await self.get(
+                query_response['nextRecordsUrl'],
+                headers=headers
+            )
+            response.raise_for_status()
+            query_response = response.json()
+
+    async def request(self, method, url, version_substitution=True,
+                      **kwargs):
+        if not self.prepared:
+            await self.prepare()
+
+        if len(self.token) == 0:
+            raise WebServerFlowNeeded(
+                'no token available',
+                self.authorization_url()
+            )
+
+        if self.access_token is None:
+            raise WebServerFlowNeeded(
+                'user logged out',
+                self.authorization_url()
+            )
+
+        if version_substitution:
+            url = await self.substitute_version(url)
+
+        if url.startswith('/'):
+            # Then it's relative
+            if 'instance_url' in self.token:
+                # We append the instance_url for convenience
+                url = '{0}{1}'.format(
+                    self.token['instance_url'],
+                    url
+                )
+            else:
+                raise WebServerFlowNeeded(
+                    'no token available',
+                    self.authorization_url()
+                )
+
+        headers = kwargs.pop('headers', None)
+        access_token = self.access_token
+        response = await self._send(method, url, headers, access_token,
+                                    kwargs)
+
+        # As in SalesforceOAuth2Session.request()
+        retry = self.retry_invalid_session or self.access_token_unverified
+        self.access_token_unverified = False
+        if retry and response.status_code == 401:
+            await self.renew_token(stale_access_token=access_token)
+            response = await self._send(method, url, headers,
+                                        self.access_token, kwargs)
+
+        return response
+
+    def _send(self, method, url, headers, access_token, kwargs):
+        headers = dict(headers or {})
+        headers['Authorization'] = 'Bearer {0}'.format(access_token)
+        return self.http_client.request(
+            method,
+            url,
+            headers=headers,
+            **kwargs
+        )
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    async def aclose(self):
+        if self.owns_http_client:
+            await self.http_client.aclose()
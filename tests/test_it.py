@@ -29,14 +29,32 @@
 '''
 
 from pytest import fixture
+from pytest import importorskip
 from getpass import getpass
 from collections import namedtuple
 import tempfile
 import os
+import shutil
+import time
+import asyncio
+import requests
+from multiprocessing.pool import ThreadPool
 from salesforce_requests_oauthlib import SalesforceOAuth2Session
 from salesforce_requests_oauthlib import WebServerFlowNeeded
 from salesforce_requests_oauthlib import HiddenLocalStorage
+from salesforce_requests_oauthlib import ShardedLocalStorage
 from salesforce_requests_oauthlib import PostgresStorage
+from salesforce_requests_oauthlib import CachedStorage
+from salesforce_requests_oauthlib import SalesforceSessionPool
+from salesforce_requests_oauthlib import revoke_url_template
+from salesforce_requests_oauthlib import APIVersionCache
+from salesforce_requests_oauthlib import prepare_sessions
+from salesforce_requests_oauthlib import CompositeBatcher
+from salesforce_requests_oauthlib import RecordDecoder
+from salesforce_requests_oauthlib import ResponseCache
+from salesforce_requests_oauthlib import SchemaCache
+from salesforce_requests_oauthlib import APILimitTracker
+from salesforce_requests_oauthlib import RetryPolicy
 from oauthlib.oauth2 import ServiceApplicationClient
 
 test_settings_path = 'test_settings'
@@ -137,6 +155,35 @@ def test_jwt_bearer_token_flow(get_oauth_info):
     assert u'objectDescribe' in response
 
 
+def test_jwt_bearer_token_cache(get_oauth_info):
+    def new_session():
+        client = ServiceApplicationClient(
+            get_oauth_info.oauth_client_id,
+            open(get_oauth_info.key_file).read(),
+            get_oauth_info.username,
+            get_oauth_info.oauth_client_id,
+            audience='https://{0}.salesforce.com'.format(
+                'test' if get_oauth_info.sandbox else 'login'
+            )
+        )
+        return SalesforceOAuth2Session(
+            get_oauth_info.oauth_client_id,
+            None,
+            get_oauth_info.username,
+            sandbox=get_oauth_info.sandbox,
+            oauth2client=client,
+            cache_access_tokens=True
+        )
+
+    first_session = new_session()
+    second_session = new_session()
+    assert second_session.access_token == first_session.access_token
+    response = second_session.get(
+        '/services/data/vXX.X/sobjects/Contact'
+    ).json()
+    assert u'objectDescribe' in response
+
+
 def test_password_flow(get_oauth_info):
     password = getpass('Enter password for {0}: '.format(
         get_oauth_info.username
@@ -164,6 +211,56 @@ def test_password_flow(get_oauth_info):
     # got something back
     assert len(query_response) > 0
 
+    streamed_records = list(session.iter_query('SELECT Id FROM User'))
+    assert len(streamed_records) == len(query_response)
+
+    for query_page in session.iter_query_pages('SELECT Id FROM User'):
+        assert u'records' in query_page
+
+    compact_records = session.query(
+        'SELECT Id FROM User',
+        record_decoder=RecordDecoder()
+    )
+    assert [record['Id'] for record in compact_records] == \
+        [record['Id'] for record in query_response]
+    assert all(u'attributes' not in record for record in compact_records)
+
+    row_records = session.query(
+        'SELECT Id, Profile.Name FROM User',
+        record_decoder=RecordDecoder.from_query(
+            'SELECT Id, Profile.Name FROM User'
+        )
+    )
+    assert [record.Id for record in row_records] == \
+        [record['Id'] for record in query_response]
+    assert all(record.Profile_Name is not None for record in row_records)
+
+    prefetched_records = session.query(
+        'SELECT Id FROM User',
+        batch_size=200,
+        prefetch_pages=2
+    )
+    assert len(prefetched_records) == len(query_response)
+
+    for chunk_by in ('Id', 'CreatedDate'):
+        chunked_records = list(session.iter_chunked_query(
+            'User',
+            ['Id'],
+            chunk_by=chunk_by,
+            chunks=3
+        ))
+        assert sorted(record['Id'] for record in chunked_records) == \
+            sorted(record['Id'] for record in query_response)
+
+    bulk_rows = list(session.bulk_query(
+        'SELECT Id FROM User',
+        max_records=1,
+        parallel_downloads=2
+    ))
+    # Bulk queries return 15 character Ids
+    assert sorted(row['Id'] for row in bulk_rows) == \
+        sorted(record['Id'][:15] for record in query_response)
+
 
 def test_webbrowser_flow(get_oauth_info):
     session = SalesforceOAuth2Session(
@@ -203,6 +300,407 @@ def test_webbrowser_flow(get_oauth_info):
     assert u'objectDescribe' in response
 
 
+def test_query_columns(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox
+    )
+    query_string = 'SELECT Id, IsActive, CreatedDate, Profile.Name FROM User'
+    records = session.query(query_string)
+
+    importorskip('pyarrow')
+    table = session.query_columns(query_string, batch_size=200)
+    assert table.num_rows == len(records)
+    assert table.column('Id').to_pylist() == \
+        [record['Id'] for record in records]
+    assert str(table.schema.field('IsActive').type) == 'bool'
+
+    described_table = session.query_columns(query_string, types='describe')
+    assert str(described_table.schema.field('CreatedDate').type) == \
+        'timestamp[ms, tz=UTC]'
+
+    importorskip('numpy')
+    columns = session.query_columns(query_string, output='numpy')
+    assert list(columns) == ['Id', 'IsActive', 'CreatedDate', 'Profile.Name']
+    assert columns['IsActive'].dtype.kind == 'b'
+    assert len(columns['Id']) == len(records)
+
+
+def test_bulk_ingest(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox
+    )
+
+    records = (
+        {'LastName': 'Bulk Test {0}'.format(i)} for i in range(10)
+    )
+    # A small max_bytes forces several jobs
+    results = list(session.bulk_ingest(
+        'Contact',
+        'insert',
+        records,
+        max_bytes=100
+    ))
+    assert len(results) == 10
+    assert all(result == 'successful' for result, row in results)
+
+    results = list(session.bulk_ingest(
+        'Contact',
+        'delete',
+        ({'Id': row['sf__Id']} for result, row in results)
+    ))
+    assert all(result == 'successful' for result, row in results)
+
+
+def test_composite_batcher(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox
+    )
+
+    with CompositeBatcher(session, max_records=3) as batcher:
+        created = [
+            batcher.create('Contact', {'LastName': 'Batch Test {0}'.format(i)})
+            for i in range(5)
+        ]
+    assert all(result.result()['success'] for result in created)
+
+    with CompositeBatcher(session, max_wait=1) as batcher:
+        retrieved = [
+            batcher.request(
+                'GET',
+                '/services/data/vXX.X/sobjects/Contact/{0}'.format(
+                    result.result()['id']
+                )
+            )
+            for result in created
+        ]
+        time.sleep(2)
+        assert all(result.done() for result in retrieved)
+        assert all(
+            result.result()['httpStatusCode'] == 200 for result in retrieved
+        )
+
+        deleted = [
+            batcher.delete(result.result()['id']) for result in created
+        ]
+    assert all(result.result()['success'] for result in deleted)
+
+
+def test_auto_refresh(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        auto_refresh=True,
+        session_timeout=10,
+        refresh_margin=5
+    )
+    first_access_token = session.access_token
+
+    time.sleep(7)
+    assert session.access_token != first_access_token
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    session.close()
+    assert session.token_refresher is None
+
+
+def test_retry_invalid_session(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        retry_invalid_session=True
+    )
+    # Revoke the access token, as a session timeout would
+    session.post(
+        revoke_url_template.format(
+            'test' if get_oauth_info.sandbox else 'login'
+        ),
+        data={
+            'token': session.access_token
+        }
+    )
+
+    def get_contact_describe(_):
+        return session.get('/services/data/vXX.X/sobjects/Contact').json()
+
+    pool = ThreadPool(8)
+    try:
+        responses = pool.map(get_contact_describe, range(8))
+    finally:
+        pool.close()
+    assert all(u'objectDescribe' in response for response in responses)
+
+
+def test_async_session(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    importorskip('httpx')
+    from salesforce_requests_oauthlib.aio import AsyncSalesforceOAuth2Session
+
+    async def run():
+        async with AsyncSalesforceOAuth2Session(
+            get_oauth_info.oauth_client_id,
+            get_oauth_info.client_secret,
+            get_oauth_info.username,
+            sandbox=get_oauth_info.sandbox,
+            retry_invalid_session=True
+        ) as session:
+            responses = await asyncio.gather(*[
+                session.get('/services/data/vXX.X/sobjects/Contact')
+                for _ in range(8)
+            ])
+            assert all(
+                u'objectDescribe' in response.json()
+                for response in responses
+            )
+
+            records = await session.query('SELECT Id FROM User')
+            assert len(records) > 0
+            streamed_records = [
+                record async for record in session.iter_query(
+                    'SELECT Id FROM User'
+                )
+            ]
+            assert len(streamed_records) == len(records)
+
+    asyncio.run(run())
+
+
+def test_api_limit_tracker(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    limit_tracker = APILimitTracker(max_concurrent=2)
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        limit_tracker=limit_tracker,
+        throttle=True
+    )
+    session.get('/services/data/vXX.X/limits/')
+    used, allowed = session.api_usage()
+    assert 0 < used <= allowed
+
+    def get_contact_describe(_):
+        return session.get('/services/data/vXX.X/sobjects/Contact').json()
+
+    pool = ThreadPool(8)
+    try:
+        responses = pool.map(get_contact_describe, range(8))
+    finally:
+        pool.close()
+    assert all(u'objectDescribe' in response for response in responses)
+    assert session.api_usage()[0] >= used + 8
+    assert limit_tracker.concurrency(session.token['instance_url']) == 2
+
+
+def test_retry_policy(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    retry_policy = RetryPolicy(backoff=0.1)
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        retry_policy=retry_policy
+    )
+    records = session.query('SELECT Id FROM User', batch_size=200)
+    assert len(records) > 0
+
+    unavailable = requests.Response()
+    unavailable.status_code = 503
+    unavailable.headers['Retry-After'] = '2'
+    unavailable._content = b'[{"errorCode": "SERVER_UNAVAILABLE"}]'
+    assert retry_policy.retry_delay(0, False, {}, response=unavailable) == 2
+    assert retry_policy.retry_delay(3, True, {}, response=unavailable) is None
+
+    locked = requests.Response()
+    locked.status_code = 400
+    locked._content = b'[{"errorCode": "UNABLE_TO_LOCK_ROW"}]'
+    assert 0 <= retry_policy.retry_delay(0, False, {}, response=locked) <= 0.1
+
+    bad_gateway = requests.Response()
+    bad_gateway.status_code = 502
+    bad_gateway._content = b''
+    assert retry_policy.retry_delay(0, False, {}, response=bad_gateway) \
+        is None
+
+
+def test_session_pool(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    pool = SalesforceSessionPool(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        max_sessions=1,
+        sandbox=get_oauth_info.sandbox
+    )
+    sessions = pool.warm_up([get_oauth_info.username] * 4)
+    assert len(pool) == 1
+    assert all(session is sessions[0] for session in sessions)
+
+    session = pool.get(get_oauth_info.username)
+    assert session is sessions[0]
+    assert session.adapters['https://'] is pool.http_adapter
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_api_version_cache(get_oauth_info):
+    temp_dir_path = tempfile.mkdtemp()
+    version_cache_path = os.path.join(temp_dir_path, 'versions.pickle')
+    version_cache = APIVersionCache(path=version_cache_path)
+
+    # Relies on the refresh token saved by test_webbrowser_flow
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        version_cache=version_cache
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+    instance_url = session.token['instance_url']
+    assert version_cache.get(instance_url) == session.version
+
+    # A cache loaded from the same file knows the version already
+    assert APIVersionCache(path=version_cache_path).get(instance_url) == \
+        session.version
+
+    # Pinned versions are used as is
+    version_cache.pin(instance_url, '40.0')
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        version_cache=version_cache
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert session.version == '40.0'
+
+    # clean up
+    shutil.rmtree(temp_dir_path)
+
+
+def test_response_cache(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    cache_path = tempfile.mkdtemp()
+    try:
+        response_cache = ResponseCache(path=cache_path)
+        session = SalesforceOAuth2Session(
+            get_oauth_info.oauth_client_id,
+            get_oauth_info.client_secret,
+            get_oauth_info.username,
+            sandbox=get_oauth_info.sandbox,
+            response_cache=response_cache
+        )
+        first_describe = session.get(
+            '/services/data/vXX.X/sobjects/Account/describe/'
+        ).json()
+        second_response = session.get(
+            '/services/data/vXX.X/sobjects/Account/describe/'
+        )
+        assert second_response.json() == first_describe
+        # Salesforce answers describes with 304 Not Modified when it can
+        assert response_cache.hits == 1
+        assert getattr(second_response, 'from_cache', False)
+
+        # A new process finds the saved response
+        disk_cache = ResponseCache(path=cache_path)
+        other_session = SalesforceOAuth2Session(
+            get_oauth_info.oauth_client_id,
+            get_oauth_info.client_secret,
+            get_oauth_info.username,
+            sandbox=get_oauth_info.sandbox,
+            response_cache=disk_cache
+        )
+        assert other_session.get(
+            '/services/data/vXX.X/sobjects/Account/describe/'
+        ).json() == first_describe
+        assert disk_cache.hits == 1
+    finally:
+        shutil.rmtree(cache_path)
+
+
+def test_schema_cache(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    cache_path = tempfile.mkdtemp()
+    try:
+        def new_session():
+            return SalesforceOAuth2Session(
+                get_oauth_info.oauth_client_id,
+                get_oauth_info.client_secret,
+                get_oauth_info.username,
+                sandbox=get_oauth_info.sandbox,
+                schema_cache=SchemaCache(path=cache_path)
+            )
+
+        session = new_session()
+        schema = session.sobject_schema('User')
+        assert session.sobject_schema('user') is schema
+        assert 'Id' in schema.field_names()
+        assert schema.field('createddate')['type'] == 'datetime'
+
+        records = session.query(
+            schema.select(['Id', 'CreatedDate']),
+            record_decoder=schema.record_decoder(['Id', 'CreatedDate'])
+        )
+        assert len(records) > 0
+        assert all(
+            hasattr(record.CreatedDate, 'year') for record in records
+        )
+
+        # Another session for the org finds the saved describe
+        other_session = new_session()
+        assert other_session.describe('User') == schema.describe
+    finally:
+        shutil.rmtree(cache_path)
+
+
+def test_lazy_session(get_oauth_info):
+    # Relies on the refresh token saved by test_webbrowser_flow
+    def new_session():
+        return SalesforceOAuth2Session(
+            get_oauth_info.oauth_client_id,
+            get_oauth_info.client_secret,
+            get_oauth_info.username,
+            sandbox=get_oauth_info.sandbox,
+            lazy=True
+        )
+
+    session = new_session()
+    assert not session.prepared
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+    assert session.prepared
+
+    sessions = [new_session() for i in range(4)]
+    prepare_sessions(sessions)
+    assert all(session.prepared for session in sessions)
+    assert all(session.access_token is not None for session in sessions)
+
+
 def test_custom_local_token_storage(get_oauth_info):
     # Yes, I know this circumvents the point of mkdtemp().  We want to test
     # the directory creation part of HiddenLocalStorage.
@@ -240,10 +738,104 @@ def test_custom_local_token_storage(get_oauth_info):
     os.rmdir(temp_dir_path)
 
 
-def test_postgres_token_storage(get_oauth_info):
-    postgres_uri = getpass(
+@fixture(scope='module')
+def get_postgres_uri():
+    return getpass(
         'Paste in a Postgres URI for testing:'
     )
+
+
+def test_sharded_local_token_storage(get_oauth_info):
+    temp_dir_path = tempfile.mkdtemp()
+
+    token_storage = ShardedLocalStorage(temp_dir_path)
+    token_storage.put('other user', 'other token')
+
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        ignore_cached_refresh_tokens=True,
+        token_storage=token_storage
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    # Test that refresh token recovery works
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        token_storage=token_storage
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    stored_tokens = token_storage.retrieve()
+    assert stored_tokens['other user'] == 'other token'
+    assert get_oauth_info.username in stored_tokens
+
+    # store() replaces the whole set of users
+    token_storage.store({'other user': 'other token'})
+    assert token_storage.get(get_oauth_info.username) is None
+
+    # clean up
+    shutil.rmtree(temp_dir_path)
+
+
+def test_cached_access_tokens(get_oauth_info):
+    temp_dir_path = tempfile.mkdtemp()
+    token_storage = HiddenLocalStorage(temp_dir_path)
+
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        ignore_cached_refresh_tokens=True,
+        token_storage=token_storage,
+        cache_access_tokens=True
+    )
+    saved_token = token_storage.get(get_oauth_info.username)
+    assert saved_token['access_token'] == session.access_token
+
+    # A new session reuses the saved access token without refreshing
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        token_storage=token_storage,
+        cache_access_tokens=True
+    )
+    assert session.access_token == saved_token['access_token']
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    # A rejected saved access token is refreshed on first use
+    saved_token['access_token'] = 'bad token'
+    token_storage.put(get_oauth_info.username, saved_token)
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        token_storage=token_storage,
+        cache_access_tokens=True
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+    assert token_storage.get(get_oauth_info.username)['access_token'] != \
+        'bad token'
+
+    # clean up
+    shutil.rmtree(temp_dir_path)
+
+
+def test_postgres_token_storage(get_oauth_info, get_postgres_uri):
+    postgres_uri = get_postgres_uri
     if len(postgres_uri) == 0:
         # Postgres token storage will not be tested
         assert True
@@ -290,6 +882,75 @@ def test_postgres_token_storage(get_oauth_info):
     # Make sure the token is gone from storage
     stored_tokens = token_storage.retrieve()
     assert get_oauth_info.username not in stored_tokens
+    assert token_storage.get(get_oauth_info.username) is None
+
+    # Single-user writes leave other users' tokens alone
+    token_storage.put('other user', 'other token')
+    token_storage.put(get_oauth_info.username, 'bad token')
+    token_storage.delete(get_oauth_info.username)
+    assert token_storage.get('other user') == 'other token'
+    token_storage.delete('other user')
+
+
+def test_pooled_postgres_token_storage(get_oauth_info, get_postgres_uri):
+    postgres_uri = get_postgres_uri
+    if len(postgres_uri) == 0:
+        # Postgres token storage will not be tested
+        assert True
+        return
+
+    token_storage = PostgresStorage(postgres_uri, pool=True)
+
+    session = SalesforceOAuth2Session(
+        get_oauth_info.oauth_client_id,
+        get_oauth_info.client_secret,
+        get_oauth_info.username,
+        sandbox=get_oauth_info.sandbox,
+        ignore_cached_refresh_tokens=True,
+        token_storage=token_storage
+    )
+    response = session.get('/services/data/vXX.X/sobjects/Contact').json()
+    assert u'objectDescribe' in response
+
+    # A second storage object for the same database shares the pool
+    second_token_storage = PostgresStorage(postgres_uri, pool=True)
+    assert second_token_storage.pool is token_storage.pool
+
+    # Simulate the server dropping an idle pooled connection
+    pg_conn = token_storage.pool.getconn()
+    pg_conn.close()
+    token_storage.pool.putconn(pg_conn)
+
+    stored_tokens = second_token_storage.retrieve()
+    assert get_oauth_info.username in stored_tokens
+
+
+def test_cached_postgres_token_storage(get_postgres_uri):
+    postgres_uri = get_postgres_uri
+    if len(postgres_uri) == 0:
+        # Postgres token storage will not be tested
+        assert True
+        return
+
+    # Two caches standing in for two worker processes
+    first_cache = CachedStorage(PostgresStorage(postgres_uri))
+    second_cache = CachedStorage(PostgresStorage(postgres_uri))
+    # Give the listeners time to connect
+    time.sleep(2)
+
+    first_cache.put('cached user', 'first token')
+    assert second_cache.get('cached user') == 'first token'
+    assert second_cache.get('cached user') == 'first token'
+    assert second_cache.misses == 1 and second_cache.hits == 1
+
+    # A rotation in one worker evicts the entry in the other
+    first_cache.put('cached user', 'second token')
+    time.sleep(2)
+    assert second_cache.get('cached user') == 'second token'
+
+    first_cache.delete('cached user')
+    first_cache.close()
+    second_cache.close()
 
 
 def test_webbrowser_flow_with_custom_domain(get_oauth_info):